@@ -1,5 +1,4 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_bootstrap import Bootstrap
 
@@ -8,10 +7,18 @@ from arch.config import Config
 app = Flask(__name__)
 app.config.from_object(Config)
 
-db = SQLAlchemy(app)
+from arch import replica
+
+db = replica.RoutingSQLAlchemy(app)
+replica.init_app(app)
 migrate = Migrate(app, db)
 
 bootstrap = Bootstrap(app)
 
 from arch import routes
 from arch import models
+from arch import scheduler
+from arch import backup
+
+reminders = scheduler.init_app(app)
+backup.init_app(app)
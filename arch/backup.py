@@ -0,0 +1,366 @@
+import os
+import time
+import shutil
+import sqlite3
+import hashlib
+import datetime
+import threading
+import uuid
+
+import click
+from sqlalchemy.engine.url import make_url
+
+from arch import utils
+
+CATALOG = 'catalog.db'
+TIME_FORMAT = '%Y%m%dT%H%M%S_%f'
+
+
+def _catalog(backup_dir):
+    """Open the backup catalog, creating it if needed. The catalog lists every backup and keeps the page hashes of the
+    newest snapshot so the next incremental backup only stores the pages that changed.
+
+    Args:
+        backup_dir (str): Backup directory
+
+    Returns:
+        sqlite3.Connection: Catalog connection
+
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    con = sqlite3.connect(os.path.join(backup_dir, CATALOG))
+    con.execute('CREATE TABLE IF NOT EXISTS backups (id INTEGER PRIMARY KEY, created TEXT, kind TEXT, file TEXT, '
+                'page_size INTEGER, page_count INTEGER, pages_written INTEGER, sha256 TEXT)')
+    con.execute('CREATE TABLE IF NOT EXISTS page_hashes (page_no INTEGER PRIMARY KEY, hash BLOB)')
+    return con
+
+
+def _online_copy(db_path, dest_path, pages, sleep):
+    """Copy a live SQLite database with the online backup API, `pages` pages per step. The source is only locked while
+    a step runs and the copy sleeps `sleep` seconds between steps, leaving writers a window to get in.
+
+    Args:
+        db_path (str): Database to copy
+        dest_path (str): Destination file
+        pages (int): Pages copied per step
+        sleep (float): Seconds to sleep between steps
+
+    Returns:
+        dict: Copy metrics, 'steps', and 'busy', 'max_pause' and 'avg_pause' in seconds where a pause is the time a
+            single step held the source
+
+    """
+    pauses = []
+    last = [time.perf_counter()]
+
+    def _progress(status, remaining, total):
+        pauses.append(time.perf_counter() - last[0])
+        if sleep and remaining:
+            time.sleep(sleep)
+        last[0] = time.perf_counter()
+
+    src = sqlite3.connect(db_path)
+    dst = sqlite3.connect(dest_path)
+    try:
+        last[0] = time.perf_counter()
+        src.backup(dst, pages=pages, progress=_progress)
+    finally:
+        dst.close()
+        src.close()
+    return {'steps': len(pauses),
+            'busy': sum(pauses),
+            'max_pause': max(pauses) if pauses else 0,
+            'avg_pause': sum(pauses) / len(pauses) if pauses else 0}
+
+
+def _temp_path(directory, suffix):
+    """Unique temporary file name in `directory` so concurrent runs never share a file. The file isn't created."""
+    return os.path.join(directory, '.{}.{}{}'.format(os.getpid(), uuid.uuid4().hex, suffix))
+
+
+def _check_integrity(path):
+    con = sqlite3.connect(path)
+    try:
+        result = con.execute('PRAGMA integrity_check').fetchone()[0]
+    finally:
+        con.close()
+    if result != 'ok':
+        raise RuntimeError('Integrity check failed for {}: {}'.format(path, result))
+
+
+def _read_pages(path):
+    """Yield (page_no, data) for every page of a SQLite database file, page numbers start at 1."""
+    con = sqlite3.connect(path)
+    page_size = con.execute('PRAGMA page_size').fetchone()[0]
+    con.close()
+    with open(path, 'rb') as f:
+        page_no = 1
+        while True:
+            data = f.read(page_size)
+            if not data:
+                break
+            yield page_no, data
+            page_no += 1
+
+
+def backup(db_path, backup_dir, full=False, full_every=24, pages=256, sleep=0.005, logger=None):
+    """Take a backup of a live SQLite database. A full backup copies the whole image, an incremental backup stores only
+    the pages that changed since the previous backup. A full backup is taken when `full` is set, when there is no
+    previous backup or after `full_every` incrementals. Every snapshot is integrity checked before it's kept. Only one
+    backup runs at a time per backup directory, guarded by its backup.lock file.
+
+    Args:
+        db_path (str): Database to back up
+        backup_dir (str): Backup directory
+        full (bool): Force a full backup
+        full_every (int): Number of incremental backups between full backups
+        pages (int): Pages copied per online backup step
+        sleep (float): Seconds to sleep between online backup steps
+        logger (logging.Logger): Optional logger for the metrics
+
+    Returns:
+        dict: Backup metrics
+
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    lock = utils.acquire_lock(os.path.join(backup_dir, 'backup.lock'))
+    if lock is None:
+        raise RuntimeError('Another backup of {} is running'.format(backup_dir))
+    try:
+        return _backup(db_path, backup_dir, full, full_every, pages, sleep, logger)
+    finally:
+        lock.close()
+
+
+def _backup(db_path, backup_dir, full, full_every, pages, sleep, logger):
+    start = time.perf_counter()
+    created = datetime.datetime.utcnow()
+    con = _catalog(backup_dir)
+    last_full = con.execute("SELECT max(id) FROM backups WHERE kind = 'full'").fetchone()[0]
+    since_full = con.execute('SELECT count(*) FROM backups WHERE id > ?', (last_full or 0,)).fetchone()[0]
+    kind = 'full' if full or last_full is None or since_full >= full_every else 'incremental'
+
+    tmp_path = _temp_path(backup_dir, '.snapshot.tmp')
+    file_name = '{}.{}.db'.format(created.strftime(TIME_FORMAT), kind)
+    file_path = os.path.join(backup_dir, file_name)
+    try:
+        copy = _online_copy(db_path, tmp_path, pages, sleep)
+        _check_integrity(tmp_path)
+
+        image_hash = hashlib.sha256()
+        old_hashes = dict(con.execute('SELECT page_no, hash FROM page_hashes')) if kind == 'incremental' else {}
+        new_hashes = {}
+        changed = []
+        page_size = 0
+        for page_no, data in _read_pages(tmp_path):
+            page_size = len(data)
+            image_hash.update(data)
+            digest = hashlib.blake2b(data, digest_size=16).digest()
+            new_hashes[page_no] = digest
+            if old_hashes.get(page_no) != digest:
+                changed.append(page_no)
+
+        if kind == 'full':
+            shutil.move(tmp_path, file_path)
+            pages_written = len(new_hashes)
+        else:
+            changed_pages = set(changed)
+            incr = sqlite3.connect(file_path)
+            with incr:
+                incr.execute('CREATE TABLE pages (page_no INTEGER PRIMARY KEY, data BLOB)')
+                incr.executemany('INSERT INTO pages VALUES (?, ?)',
+                                 ((n, d) for n, d in _read_pages(tmp_path) if n in changed_pages))
+            incr.close()
+            os.remove(tmp_path)
+            pages_written = len(changed)
+
+        with con:
+            con.execute('INSERT INTO backups (created, kind, file, page_size, page_count, pages_written, sha256) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (created.isoformat(), kind, file_name, page_size, len(new_hashes), pages_written,
+                         image_hash.hexdigest()))
+            if kind == 'full':
+                con.execute('DELETE FROM page_hashes')
+            else:
+                con.execute('DELETE FROM page_hashes WHERE page_no > ?', (len(new_hashes),))
+            con.executemany('INSERT OR REPLACE INTO page_hashes VALUES (?, ?)', ((n, new_hashes[n]) for n in changed))
+    except Exception:
+        # Don't leave a full size snapshot or an uncatalogued backup behind
+        for path in (tmp_path, file_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    finally:
+        con.close()
+
+    duration = time.perf_counter() - start
+    image_bytes = page_size * len(new_hashes)
+    metrics = {'kind': kind,
+               'file': file_name,
+               'pages': len(new_hashes),
+               'pages_written': pages_written,
+               'bytes_written': page_size * pages_written,
+               'seconds': duration,
+               'copy_mb_per_sec': image_bytes / copy['busy'] / 1e6 if copy['busy'] else 0,
+               'steps': copy['steps'],
+               'max_pause_ms': copy['max_pause'] * 1000,
+               'avg_pause_ms': copy['avg_pause'] * 1000}
+    if logger:
+        logger.info('Backup %(kind)s %(file)s: %(pages_written)s/%(pages)s pages in %(seconds).2fs, '
+                    'copy %(copy_mb_per_sec).1f MB/s over %(steps)s steps, max pause %(max_pause_ms).1f ms, '
+                    'avg pause %(avg_pause_ms).1f ms', metrics)
+    return metrics
+
+
+def restore(backup_dir, target_path, at=None):
+    """Restore the database as of the newest backup taken at or before `at` by copying its full backup and applying
+    the incremental backups after it. The rebuilt image is checked against the recorded hash and integrity checked
+    before it replaces `target_path`.
+
+    Args:
+        backup_dir (str): Backup directory
+        target_path (str): Path to write the restored database to, the app should be stopped if this is its database
+        at (datetime.datetime): Point in time to restore in UTC, defaults to the newest backup
+
+    Returns:
+        dict: The backup row that was restored
+
+    """
+    con = _catalog(backup_dir)
+    con.row_factory = sqlite3.Row
+    at = (at or datetime.datetime.utcnow()).isoformat()
+    rows = con.execute('SELECT * FROM backups WHERE created <= ? ORDER BY id', (at,)).fetchall()
+    con.close()
+    if not rows:
+        raise RuntimeError('No backup at or before {}'.format(at))
+
+    base = max(i for i, r in enumerate(rows) if r['kind'] == 'full')
+    chain = rows[base:]
+    tmp_path = _temp_path(os.path.dirname(os.path.abspath(target_path)), '.restore.tmp')
+    try:
+        shutil.copyfile(os.path.join(backup_dir, chain[0]['file']), tmp_path)
+        with open(tmp_path, 'r+b') as f:
+            for row in chain[1:]:
+                incr = sqlite3.connect(os.path.join(backup_dir, row['file']))
+                for page_no, data in incr.execute('SELECT page_no, data FROM pages'):
+                    f.seek((page_no - 1) * row['page_size'])
+                    f.write(data)
+                incr.close()
+                f.truncate(row['page_count'] * row['page_size'])
+
+        image_hash = hashlib.sha256()
+        for _, data in _read_pages(tmp_path):
+            image_hash.update(data)
+        if image_hash.hexdigest() != chain[-1]['sha256']:
+            raise RuntimeError('Restored image does not match backup {}'.format(chain[-1]['file']))
+        _check_integrity(tmp_path)
+        os.replace(tmp_path, target_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return dict(chain[-1])
+
+
+def verify(backup_dir):
+    """Restore every backup to a temporary file to check the whole chain can be rebuilt.
+
+    Args:
+        backup_dir (str): Backup directory
+
+    Returns:
+        int: Number of backups verified
+
+    """
+    con = _catalog(backup_dir)
+    created = [r[0] for r in con.execute('SELECT created FROM backups ORDER BY id')]
+    con.close()
+    tmp_path = _temp_path(backup_dir, '.verify.tmp')
+    try:
+        for c in created:
+            restore(backup_dir, tmp_path, at=datetime.datetime.fromisoformat(c))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return len(created)
+
+
+def init_app(app):
+    """Register the `flask backup`, `flask restore` and `flask verify-backups` commands and, if BACKUP_INTERVAL is
+    set, take a backup every BACKUP_INTERVAL seconds in a background thread. The thread starts as soon as the serving
+    process loads the app, and only in the process holding BACKUP_DIR's schedule.lock, so CLI commands and the debug
+    reloader's watcher process never run it. Only SQLite databases are supported.
+
+    Args:
+        app (flask.Flask): Application to set up
+
+    Returns:
+        None
+
+    """
+    def _db_path():
+        url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        if url.get_backend_name() != 'sqlite':
+            raise click.ClickException('Backups are only supported for SQLite databases')
+        return url.database
+
+    def _backup(full=False):
+        return backup(_db_path(), app.config['BACKUP_DIR'], full=full, full_every=app.config['BACKUP_FULL_EVERY'],
+                      pages=app.config['BACKUP_PAGES_PER_STEP'], logger=app.logger)
+
+    @app.cli.command('backup')
+    @click.option('--full', is_flag=True, help='Take a full backup instead of an incremental one.')
+    def backup_command(full):
+        """Take an online backup of the database."""
+        try:
+            metrics = _backup(full=full)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        for k, v in metrics.items():
+            click.echo('{}: {}'.format(k, round(v, 3) if isinstance(v, float) else v))
+
+    @app.cli.command('restore')
+    @click.argument('target')
+    @click.option('--at', default=None, help='UTC time to restore to, eg 2020-04-20T16:00:00. Defaults to newest.')
+    def restore_command(target, at):
+        """Restore the database to TARGET as of a point in time."""
+        try:
+            at = datetime.datetime.fromisoformat(at) if at else None
+        except ValueError:
+            raise click.BadParameter('{!r} is not an ISO 8601 time'.format(at), param_hint='--at')
+        try:
+            row = restore(app.config['BACKUP_DIR'], target, at=at)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        click.echo('Restored {} ({}) to {}'.format(row['file'], row['created'], target))
+
+    @app.cli.command('verify-backups')
+    def verify_command():
+        """Check every backup can be restored."""
+        try:
+            count = verify(app.config['BACKUP_DIR'])
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        click.echo('Verified {} backups'.format(count))
+
+    interval = app.config.get('BACKUP_INTERVAL')
+    if interval and make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name() == 'sqlite':
+        def _backup_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    _backup()
+                except Exception:
+                    app.logger.exception('Scheduled backup failed')
+
+        def _start_backups():
+            os.makedirs(app.config['BACKUP_DIR'], exist_ok=True)
+            lock = utils.acquire_lock(os.path.join(app.config['BACKUP_DIR'], 'schedule.lock'))
+            if lock is None:
+                app.logger.info('Scheduled backups are run by another process')
+                return
+            app.extensions['backup_lock'] = lock
+            thread = threading.Thread(target=_backup_loop, name='backup', daemon=True)
+            thread.start()
+
+        utils.on_serve(app, _start_backups)
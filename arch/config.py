@@ -8,3 +8,19 @@ class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or "El0O1J0mgOCfu79u6axtwfCROdgKku0r"
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or DEFAULT_DB
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Optional read replica, GET requests read from it unless the client wrote recently
+    SQLALCHEMY_BINDS = {'replica': os.environ['REPLICA_DATABASE_URL']} if 'REPLICA_DATABASE_URL' in os.environ else {}
+    REPLICA_SNAPSHOT_INTERVAL = int(os.environ.get('REPLICA_SNAPSHOT_INTERVAL') or 0)  # Seconds, required for SQLite
+    REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS') or 60)
+    IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL') or 24 * 60 * 60)  # Seconds
+    IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE') or 1024)
+    # Reminders for overdue schedules, logged and optionally POSTed to REMINDER_WEBHOOK_URL
+    REMINDERS_ENABLED = bool(os.environ.get('REMINDERS_ENABLED'))
+    REMINDER_REPEAT = int(os.environ.get('REMINDER_REPEAT') or 60 * 60)  # Seconds between repeat reminders
+    REMINDER_WEBHOOK_URL = os.environ.get('REMINDER_WEBHOOK_URL')
+    REMINDER_LOCK_FILE = os.environ.get('REMINDER_LOCK_FILE') or os.path.join(basedir, 'reminders.lock')
+    # Online SQLite backups, see `flask backup` and `flask restore`
+    BACKUP_DIR = os.environ.get('BACKUP_DIR') or os.path.join(basedir, 'backups')
+    BACKUP_INTERVAL = int(os.environ.get('BACKUP_INTERVAL') or 0)  # Seconds between scheduled backups, 0 disables
+    BACKUP_FULL_EVERY = int(os.environ.get('BACKUP_FULL_EVERY') or 24)  # Incremental backups between full backups
+    BACKUP_PAGES_PER_STEP = int(os.environ.get('BACKUP_PAGES_PER_STEP') or 256)
@@ -34,3 +34,26 @@ class EventForm(FlaskForm):
     note = wtforms.StringField('Note', default=None)
     accident = wtforms.BooleanField('Accident?')
     submit = wtforms.SubmitField('Submit')
+
+
+class BulkEventForm(FlaskForm):
+    no_change = [(0, '-- Any --')]
+    accident_list = [('', '-- No Change --'), ('1', 'Yes'), ('0', 'No')]
+
+    # Selection
+    event_ids = wtforms.StringField('Event IDs (comma separated)', validators=[validators.Optional()])
+    filter_user = wtforms.SelectField('Logged By', choices=no_change + EventForm.user_list, coerce=int, default=0)
+    filter_dog = wtforms.SelectField('With Dog', choices=no_change + EventForm.dog_list, coerce=int, default=0)
+    filter_event = wtforms.SelectField('Of Type', choices=no_change + EventForm.event_type_list, coerce=int,
+                                       default=0)
+    filter_date = html5.DateField('On Date', validators=[validators.Optional()], default=None)
+
+    # Changes
+    user = wtforms.SelectField('Set User', choices=no_change + EventForm.user_list, coerce=int, default=0)
+    event = wtforms.SelectField('Set Event', choices=no_change + EventForm.event_type_list, coerce=int, default=0)
+    accident = wtforms.SelectField('Set Accident?', choices=accident_list, default='')
+    time_shift = wtforms.IntegerField('Shift Time (Minutes)', validators=[validators.Optional()], default=None)
+    dog = wtforms.SelectMultipleField('Set Dogs', choices=EventForm.dog_list, coerce=int,
+                                      validators=[validators.Optional()])
+    submit = wtforms.SubmitField('Apply')
+    delete = wtforms.SubmitField('Delete Matching')
@@ -1,15 +1,22 @@
 import os
+import hashlib
+import collections
 import datetime
 
 import pytz
-from sqlalchemy import or_
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import or_, func, exc, orm, text, event as sa_event
 
 import arch
-from arch import app, db
+from arch import app, db, utils
+
+#: Session info key set when events are changed in ways that can move a reminder's due time back
+EVENTS_CHANGED = 'events_changed'
 
 dog_to_event = db.Table('dog_to_event_table',  #: Association Table to connect Dog with Event objects
                         db.Column('event_id', db.Integer, db.ForeignKey('events.id')),
-                        db.Column('dog_id', db.Integer, db.ForeignKey('dogs.id')))
+                        db.Column('dog_id', db.Integer, db.ForeignKey('dogs.id')),
+                        db.Index('ix_dog_to_event_table_dog_id_event_id', 'dog_id', 'event_id'))
 
 
 class ActiveEvent(db.Model):
@@ -65,6 +72,9 @@ class EventType(db.Model):
     def __repr__(self):
         return '<EventType {} [{}]>'.format(self.id, self.name)
 
+    def to_dict(self):
+        return {'id': self.id, 'name': self.name}
+
 
 class Users(db.Model):
     """User Table
@@ -83,6 +93,9 @@ class Users(db.Model):
     def __repr__(self):
         return '<User {} [{}]>'.format(self.id, self.username)
 
+    def to_dict(self):
+        return {'id': self.id, 'username': self.username}
+
 
 class Dog(db.Model):
     """Dog Table
@@ -101,6 +114,9 @@ class Dog(db.Model):
     def __repr__(self):
         return '<Dog {} [{}]>'.format(self.id, self.name)
 
+    def to_dict(self):
+        return {'id': self.id, 'name': self.name, 'birthday': self.birthday.isoformat() if self.birthday else None}
+
 
 class Event(db.Model):
     """Event Table
@@ -132,9 +148,27 @@ class Event(db.Model):
     end_time = db.Column(db.DateTime)
     is_accident = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (db.Index('ix_events_event_type_id_start_time', 'event_type_id', 'start_time'),)
+
     def __repr__(self):
         return '<Event {} [{}]>'.format(self.id, self.event_type.name)
 
+    def to_dict(self):
+        """Returns a compact dict of the event with times as UTC timestamps, the same format the webhooks accept.
+
+        Returns:
+            dict: Event data
+
+        """
+        return {'id': self.id,
+                'user_id': self.user_id,
+                'event_type_id': self.event_type_id,
+                'dog_ids': [d.id for d in self.dogs],
+                'note': self.note,
+                'start_time': _to_timestamp(self.start_time),
+                'end_time': _to_timestamp(self.end_time),
+                'is_accident': self.is_accident}
+
     @property
     def start_time_local(self):
         """Returns the start_time in local time (default Los Angeles).
@@ -143,11 +177,7 @@ class Event(db.Model):
             datetime.datetime: start_time attribute converted to local time
 
         """
-        if self.start_time:
-            tz = pytz.timezone("America/Los_Angeles")
-            utc = pytz.timezone('UTC')
-            value = utc.localize(self.start_time, is_dst=None).astimezone(pytz.utc)
-            return value.astimezone(tz)
+        return _to_local(self.start_time)
 
     @property
     def end_time_local(self):
@@ -157,11 +187,7 @@ class Event(db.Model):
             datetime.datetime: end_time attribute converted to local time
 
         """
-        if self.end_time:
-            tz = pytz.timezone("America/Los_Angeles")
-            utc = pytz.timezone('UTC')
-            value = utc.localize(self.end_time, is_dst=None).astimezone(pytz.utc)
-            return value.astimezone(tz)
+        return _to_local(self.end_time)
 
     @property
     def event_string(self):
@@ -173,15 +199,8 @@ class Event(db.Model):
             str: Event header info string
 
         """
-        duration_string = ""
-        if self.start_time and self.end_time:
-            duration = self.end_time - self.start_time
-            s = duration.total_seconds()
-            hours, remainder = divmod(s, 3600)
-            minutes, seconds = divmod(remainder, 60)
-            duration_string = ' - {:01}:{:02}:{:02}'.format(int(hours), int(minutes), int(seconds))
         dogs = ', '.join([d.name for d in self.dogs])
-        return '{0} - {1}{2}'.format(self.event_type.name.capitalize(), dogs, duration_string)
+        return _event_string(self.event_type.name, dogs, self.start_time, self.end_time)
 
     @property
     def event_entry(self):
@@ -192,11 +211,48 @@ class Event(db.Model):
             str: Event entry info string
 
         """
-        note_string = ''
-        if self.note:
-            note_string = ' - {}'.format(self.note)
-        nice_time = self.start_time_local.strftime("%I:%M %p")
-        return '{0} @ {1}{2}'.format(self.user.username, nice_time, note_string)
+        return _event_entry(self.user.username, self.start_time, self.note)
+
+    @property
+    def event_type_name(self):
+        """Returns the name of the event type, shared with `EventView` so templates accept either.
+
+        Returns:
+            str: Event type name
+
+        """
+        return self.event_type.name
+
+    @classmethod
+    def views(cls, *criteria, limit=None, offset=None):
+        """Read only path for rendering events. Selects just the columns the templates need, with the dog names
+        aggregated in the database, into `EventView` tuples instead of hydrating and tracking full Event objects.
+
+        Args:
+            *criteria: Optional filter criteria, eg `Event.start_time >= start`
+            limit (int): Maximum number of events to return
+            offset (int): Number of events to skip
+
+        Returns:
+            list of EventView: Matching events ordered by id
+
+        """
+        if db.engine.dialect.name == 'postgresql':
+            dogs = func.string_agg(Dog.name, ', ')
+        else:
+            dogs = func.group_concat(Dog.name, ', ')
+        query = db.session.query(cls.id, EventType.name, Users.username, cls.note, cls.start_time, cls.end_time,
+                                 cls.is_accident, dogs).\
+            outerjoin(EventType, EventType.id == cls.event_type_id).\
+            outerjoin(Users, Users.id == cls.user_id).\
+            outerjoin(dog_to_event, dog_to_event.c.event_id == cls.id).\
+            outerjoin(Dog, Dog.id == dog_to_event.c.dog_id).\
+            filter(*criteria).\
+            group_by(cls.id, EventType.name, Users.username).\
+            order_by(cls.id).\
+            limit(limit).\
+            offset(offset)
+        return [EventView.from_row(*row) for row in query]
 
     @staticmethod
     def event_factory(**kwargs):
@@ -283,6 +339,565 @@ class Event(db.Model):
             return -1
         return ins
 
+    @classmethod
+    def bulk_ids(cls, event_ids=None, user_id=None, dog_id=None, event_type_id=None, start_time=None,
+                 end_time=None, is_accident=None):
+        """Resolve the ids of every event matching the given filter with a single id-only query. At least one filter
+        must be given so an empty filter never matches the whole table.
+
+        Args:
+            event_ids (list of int): Explicit list of event ids
+            user_id (int): Only events logged by this user
+            dog_id (int): Only events associated with this dog
+            event_type_id (int): Only events of this type
+            start_time (datetime.datetime): Only events starting at or after this time (UTC)
+            end_time (datetime.datetime): Only events starting before this time (UTC)
+            is_accident (bool): Only events with this accident flag
+
+        Returns:
+            list of int: Matching event ids
+
+        """
+        criteria = []
+        if event_ids:
+            criteria.append(cls.id.in_(tuple(event_ids)))
+        if user_id:
+            criteria.append(cls.user_id == user_id)
+        if dog_id:
+            criteria.append(cls.id.in_(db.session.query(dog_to_event.c.event_id).
+                                       filter(dog_to_event.c.dog_id == dog_id)))
+        if event_type_id:
+            criteria.append(cls.event_type_id == event_type_id)
+        if start_time:
+            criteria.append(cls.start_time >= start_time)
+        if end_time:
+            criteria.append(cls.start_time < end_time)
+        if is_accident is not None:
+            criteria.append(cls.is_accident == is_accident)
+
+        if not criteria:
+            app.logger.error("Refusing to resolve a bulk selection without any filter")
+            return []
+        return [r.id for r in db.session.query(cls.id).filter(*criteria)]
+
+    @classmethod
+    def bulk_update(cls, event_ids, user_id=None, event_type_id=None, is_accident=None, time_shift=None, dog_ids=None):
+        """Apply the same change to many events at once using set based UPDATE/DELETE/INSERT statements in a single
+        transaction, without loading any Event objects.
+
+        Args:
+            event_ids (list of int): Event ids to update, usually from `Event.bulk_ids`
+            user_id (int): New user id
+            event_type_id (int): New event type id
+            is_accident (bool): New accident flag
+            time_shift (datetime.timedelta): Offset added to both start_time and end_time
+            dog_ids (list of int): Replaces the set of dogs on every event
+
+        Returns:
+            dict: Affected row counts keyed by 'events' and 'dogs'
+
+        Raises:
+            ValueError: If any of `dog_ids` isn't an existing dog
+
+        """
+        result = {'events': 0, 'dogs': 0}
+        if not event_ids:
+            return result
+
+        if dog_ids:
+            dog_ids = set(dog_ids)
+            unknown = dog_ids - {r.id for r in db.session.query(Dog.id).filter(Dog.id.in_(tuple(dog_ids)))}
+            if unknown:
+                raise ValueError('Unknown dog ids {}'.format(sorted(unknown, key=str)))
+
+        values = {}
+        if user_id:
+            values[cls.user_id] = user_id
+        if event_type_id:
+            values[cls.event_type_id] = event_type_id
+        if is_accident is not None:
+            values[cls.is_accident] = is_accident
+        if time_shift:
+            values[cls.start_time] = _shift_time(cls.start_time, time_shift)
+            values[cls.end_time] = _shift_time(cls.end_time, time_shift)
+
+        try:
+            if values:
+                result['events'] = cls.query.filter(cls.id.in_(tuple(event_ids))).\
+                    update(values, synchronize_session=False)
+
+            if values or dog_ids is not None:
+                ChangeLog.log(cls.__tablename__, event_ids, 'update')
+
+            if dog_ids is not None:
+                db.session.execute(dog_to_event.delete().where(dog_to_event.c.event_id.in_(tuple(event_ids))))
+                pairs = db.select([cls.id, Dog.id]).\
+                    where(cls.id.in_(tuple(event_ids))).\
+                    where(Dog.id.in_(tuple(dog_ids)))
+                inserted = db.session.execute(dog_to_event.insert().from_select(['event_id', 'dog_id'], pairs))
+                result['dogs'] = inserted.rowcount
+
+            db.session.info[EVENTS_CHANGED] = True
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        db.session.expire_all()
+        return result
+
+    @classmethod
+    def bulk_delete(cls, event_ids):
+        """Delete many events, along with their dog associations and any active event pointing at them, using set based
+        DELETE statements in a single transaction.
+
+        Args:
+            event_ids (list of int): Event ids to delete, usually from `Event.bulk_ids`
+
+        Returns:
+            dict: Deleted row counts keyed by 'events', 'dogs' and 'active_events'
+
+        """
+        result = {'events': 0, 'dogs': 0, 'active_events': 0}
+        if not event_ids:
+            return result
+
+        ids = tuple(event_ids)
+        try:
+            result['dogs'] = db.session.execute(dog_to_event.delete().where(dog_to_event.c.event_id.in_(ids))).rowcount
+            result['active_events'] = ActiveEvent.query.filter(ActiveEvent.event_id.in_(ids)).\
+                delete(synchronize_session=False)
+            result['events'] = cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
+            ChangeLog.log(cls.__tablename__, ids, 'delete')
+            IdempotencyKey.forget_events(ids)
+            db.session.info[EVENTS_CHANGED] = True
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        db.session.expire_all()
+        return result
+
+
+class EventView(collections.namedtuple('EventView', ['id', 'event_type_name', 'is_accident', 'event_string',
+                                                     'event_entry'])):
+    """Lightweight read only event for templates, built by `Event.views` with the display strings precomputed.
+
+    Attributes:
+        id (int): Event ID
+        event_type_name (str): Name of the event type
+        is_accident (bool): Boolean if the event is an accident or not
+        event_string (str): Same as `Event.event_string`
+        event_entry (str): Same as `Event.event_entry`
+
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_row(cls, event_id, event_type_name, username, note, start_time, end_time, is_accident, dogs):
+        return cls(event_id, event_type_name, is_accident,
+                   _event_string(event_type_name, dogs or '', start_time, end_time),
+                   _event_entry(username, start_time, note))
+
+
+def _to_local(value):
+    """Convert a naive UTC datetime to local time (default Los Angeles).
+
+    Args:
+        value (datetime.datetime): Naive UTC datetime or None
+
+    Returns:
+        datetime.datetime: Value converted to local time or None
+
+    """
+    if value:
+        tz = pytz.timezone("America/Los_Angeles")
+        utc = pytz.timezone('UTC')
+        value = utc.localize(value, is_dst=None).astimezone(pytz.utc)
+        return value.astimezone(tz)
+
+
+def _event_string(event_type_name, dogs, start_time, end_time):
+    duration_string = ""
+    if start_time and end_time:
+        duration = end_time - start_time
+        s = duration.total_seconds()
+        hours, remainder = divmod(s, 3600)
+        minutes, seconds = divmod(remainder, 60)
+        duration_string = ' - {:01}:{:02}:{:02}'.format(int(hours), int(minutes), int(seconds))
+    return '{0} - {1}{2}'.format(event_type_name.capitalize(), dogs, duration_string)
+
+
+def _event_entry(username, start_time, note):
+    note_string = ''
+    if note:
+        note_string = ' - {}'.format(note)
+    nice_time = _to_local(start_time).strftime("%I:%M %p")
+    return '{0} @ {1}{2}'.format(username, nice_time, note_string)
+
+
+def _to_timestamp(value):
+    if value:
+        return int(value.replace(tzinfo=pytz.utc).timestamp())
+
+
+def _shift_time(column, delta):
+    """Build a SQL expression adding `delta` to a DateTime column. SQLite stores DateTime as text so the shift is done
+    with its date functions, keeping the fractional seconds SQLAlchemy writes after the 19th character.
+
+    Args:
+        column (Column): DateTime column to shift
+        delta (datetime.timedelta): Offset to add
+
+    Returns:
+        ColumnElement: SQL expression for the shifted value
+
+    """
+    if db.engine.dialect.name == 'sqlite':
+        modifier = '{:+d} seconds'.format(int(delta.total_seconds()))
+        return func.strftime('%Y-%m-%d %H:%M:%S', column, modifier).op('||')(func.substr(column, 20))
+    return column + delta
+
+
+class IdempotencyKey(db.Model):
+    """Idempotency Key Table, remembers which event a webhook submission created so retries don't create duplicates.
+
+    Attributes:
+        id (int): Primary Key (Unique)
+        key (str): Idempotency key sent by the client or derived from the event (Unique) (Max 64)
+        event_id (int): ID of the event created by the first submission with this key
+        created (DateTime): Time the key was stored in UTC, keys older than IDEMPOTENCY_KEY_TTL are expired
+
+    """
+    __tablename__ = 'idempotency_keys'
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), index=True, unique=True)
+    event_id = db.Column(db.Integer)
+    created = db.Column(db.DateTime, index=True, default=datetime.datetime.utcnow)
+
+    #: In-memory pre-filter of recently stored keys, maps key -> (event_id, created)
+    cache = utils.LRUCache(app.config['IDEMPOTENCY_CACHE_SIZE'])
+    #: Expired keys are purged at most once per PURGE_INTERVAL
+    PURGE_INTERVAL = datetime.timedelta(hours=1)
+    _last_purge = None
+
+    def __repr__(self):
+        return '<IdempotencyKey {} [{}]>'.format(self.key, self.event_id)
+
+    @staticmethod
+    def derive(event, start_time_given=True):
+        """Derive a key from the user, event type, dogs and start_time of an unsaved event. Without an explicit
+        start_time two submissions can't be told apart from two real events, so no key is derived.
+
+        Args:
+            event (Event): Event built by `Event.event_factory`
+            start_time_given (bool): If the submission included a start_time
+
+        Returns:
+            str: Hex digest key or None
+
+        """
+        if not start_time_given or not event.start_time:
+            return None
+        parts = [event.user.id, event.event_type.id, sorted(d.id for d in event.dogs), event.start_time.isoformat()]
+        return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _expired(cls, created):
+        return created < datetime.datetime.utcnow() - datetime.timedelta(seconds=app.config['IDEMPOTENCY_KEY_TTL'])
+
+    @classmethod
+    def purge_expired(cls):
+        """Delete every expired key.
+
+        Returns:
+            int: Number of keys deleted
+
+        """
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=app.config['IDEMPOTENCY_KEY_TTL'])
+        count = cls.query.filter(cls.created < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+    @classmethod
+    def forget_events(cls, event_ids):
+        """Delete the keys pointing at events that are being deleted, so a retry creates a new event instead of
+        returning a dead id. Runs in the caller's transaction.
+
+        Args:
+            event_ids (list of int): IDs of the events being deleted
+
+        Returns:
+            int: Number of keys deleted
+
+        """
+        keys = [r.key for r in db.session.query(cls.key).filter(cls.event_id.in_(tuple(event_ids)))]
+        if not keys:
+            return 0
+        for key in keys:
+            cls.cache.pop(key)
+        return cls.query.filter(cls.key.in_(tuple(keys))).delete(synchronize_session=False)
+
+    @classmethod
+    def add_event(cls, event, key):
+        """Add an event to the database unless an unexpired submission with the same key already exists. The common
+        case of a new key costs no extra query, the unique index on `key` catches any duplicate missed by the cache.
+
+        Args:
+            event (Event): Unsaved event
+            key (str): Idempotency key, if None the event is always added
+
+        Returns:
+            tuple: (int event id, bool True if the event was created or False if it was a duplicate)
+
+        """
+        if key is None:
+            db.session.add(event)
+            db.session.commit()
+            return event.id, True
+
+        cached = cls.cache.get(key)
+        if cached and not cls._expired(cached[1]):
+            return cached[0], False
+
+        for _ in range(2):
+            try:
+                db.session.add(event)
+                db.session.flush()
+                event_id, created = event.id, datetime.datetime.utcnow()
+                db.session.add(cls(key=key, event_id=event_id, created=created))
+                db.session.commit()
+            except exc.IntegrityError:
+                db.session.rollback()
+                existing = cls.query.filter_by(key=key).first()
+                if existing is None:
+                    raise
+                if not cls._expired(existing.created):
+                    cls.cache.set(key, (existing.event_id, existing.created))
+                    return existing.event_id, False
+                # Expired key that hasn't been purged yet, drop it and try again
+                db.session.delete(existing)
+                db.session.commit()
+                continue
+            # Cache the values set above, reading them back from the expired objects would cost another query
+            cls.cache.set(key, (event_id, created))
+            if cls._last_purge is None or created - cls._last_purge > cls.PURGE_INTERVAL:
+                cls._last_purge = created
+                cls.purge_expired()
+            return event_id, True
+        raise RuntimeError('Unable to store idempotency key {}'.format(key))
+
+
+class ChangeLog(db.Model):
+    """Change Log Table, one row per insert, update or delete of a synced model. The id only ever increases so clients
+    use the last id they've seen as a cursor for `changes_since`. Ids must also be handed out in commit order or a
+    client could move its cursor past a change that commits later. SQLite only allows one writer at a time, on
+    Postgres writers take an advisory lock before their first change log row, see `_lock_change_log`.
+
+    Attributes:
+        id (int): Primary Key (Unique), the sequence number of the change
+        table_name (str): Table of the changed row
+        row_id (int): Primary key of the changed row
+        op (str): 'insert', 'update' or 'delete'
+
+    """
+    __tablename__ = 'change_log'
+    __table_args__ = (db.Index('ix_change_log_table_name_row_id_id', 'table_name', 'row_id', 'id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(32))
+    row_id = db.Column(db.Integer)
+    op = db.Column(db.String(8))
+
+    #: Models whose changes are logged, by table name
+    TRACKED = {}
+
+    def __repr__(self):
+        return '<ChangeLog {} [{} {} {}]>'.format(self.id, self.op, self.table_name, self.row_id)
+
+    @classmethod
+    def log(cls, table_name, row_ids, op):
+        """Log the same change for many rows with a single executemany INSERT in the current transaction.
+
+        Args:
+            table_name (str): Table of the changed rows
+            row_ids (list of int): Primary keys of the changed rows
+            op (str): 'insert', 'update' or 'delete'
+
+        Returns:
+            None
+
+        """
+        rows = [{'table_name': table_name, 'row_id': i, 'op': op} for i in row_ids]
+        if rows:
+            _lock_change_log(db.session)
+            db.session.execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def cursor(cls):
+        """Returns the newest change id, or 0 if nothing has been logged.
+
+        Returns:
+            int: Current cursor
+
+        """
+        return db.session.query(func.max(cls.id)).scalar() or 0
+
+    @classmethod
+    def changes_since(cls, since, limit=500):
+        """Return the changes after a cursor, at most `limit` log entries at a time. Repeated changes to the same row
+        are collapsed to the row's current state, or to a delete if the last change was a delete.
+
+        Args:
+            since (int): Cursor, the last change id the client has seen
+            limit (int): Maximum number of log entries to read
+
+        Returns:
+            dict: {'cursor': next cursor, 'more': bool, 'changes': {table_name: {'upsert': [dict], 'delete': [int]}}}
+
+        """
+        entries = cls.query.filter(cls.id > since).order_by(cls.id).limit(limit + 1).all()
+        more = len(entries) > limit
+        entries = entries[:limit]
+
+        latest = {}
+        for entry in entries:
+            latest[(entry.table_name, entry.row_id)] = entry.op
+
+        changes = {}
+        for table_name, model in cls.TRACKED.items():
+            deleted = [row_id for (t, row_id), op in latest.items() if t == table_name and op == 'delete']
+            changed = [row_id for (t, row_id), op in latest.items() if t == table_name and op != 'delete']
+            if not deleted and not changed:
+                continue
+            query = model.query.filter(model.id.in_(tuple(changed)))
+            if model is Event:
+                query = query.options(orm.selectinload(Event.dogs))
+            upserts = [r.to_dict() for r in query] if changed else []
+            changes[table_name] = {'upsert': upserts, 'delete': deleted}
+
+        return {'cursor': entries[-1].id if entries else since, 'more': more, 'changes': changes}
+
+    @classmethod
+    def last_change(cls, table_name, row_id):
+        """Returns the id of the newest change to a row.
+
+        Args:
+            table_name (str): Table of the row
+            row_id (int): Primary key of the row
+
+        Returns:
+            int: Change id or None
+
+        """
+        return db.session.query(func.max(cls.id)).filter_by(table_name=table_name, row_id=row_id).scalar()
+
+    @classmethod
+    def has_conflict(cls, table_name, row_id, since):
+        """Check if a row changed after the client's cursor.
+
+        Args:
+            table_name (str): Table of the row
+            row_id (int): Primary key of the row
+            since (int): Cursor the client's change was based on
+
+        Returns:
+            bool: True if the row changed after `since`
+
+        """
+        query = db.session.query(cls.id).filter_by(table_name=table_name, row_id=row_id).filter(cls.id > since)
+        return db.session.query(query.exists()).scalar()
+
+
+ChangeLog.TRACKED = {m.__tablename__: m for m in [Event, Dog, Users, EventType]}
+
+CHANGE_LOG_LOCK = 0x61726368  #: Postgres advisory lock key serializing change log writers
+
+
+def _lock_change_log(session):
+    """On Postgres take a transaction level advisory lock before allocating change log ids. The lock is held until
+    commit, so a transaction that gets a later id always commits after one holding an earlier id.
+
+    Args:
+        session (Session): Session writing the change log
+
+    Returns:
+        None
+
+    """
+    if db.engine.dialect.name == 'postgresql':
+        session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': CHANGE_LOG_LOCK})
+
+
+@sa_event.listens_for(db.session, 'after_flush')
+def _log_changes(session, flush_context):
+    """Write a ChangeLog row for every tracked object inserted, updated or deleted by a flush."""
+    rows = []
+    for objects, op in [(session.new, 'insert'), (session.dirty, 'update'), (session.deleted, 'delete')]:
+        for obj in objects:
+            if obj.__tablename__ not in ChangeLog.TRACKED:
+                continue
+            if op == 'update' and not session.is_modified(obj):
+                continue
+            rows.append({'table_name': obj.__tablename__, 'row_id': obj.id, 'op': op})
+    if rows:
+        _lock_change_log(session)
+        session.execute(ChangeLog.__table__.insert(), rows)
+
+
+class Schedule(db.Model):
+    """Schedule Table, how often an event type is expected for a dog (eg CLOMIPRAMINE every 12 hours or TRIFEXIS
+    every month).
+
+    Attributes:
+        id (int): Primary Key (Unique)
+        dog_id (int): ID of the Dog this schedule is for
+        dog (Dog): Dog this schedule is for
+        event_type_id (int): ID for the Event Type expected
+        event_type (EventType): Event Type expected
+        hours (int): Hours between events
+        months (int): Months between events, added to hours
+
+    """
+    __tablename__ = 'schedules'
+    id = db.Column(db.Integer, primary_key=True)
+    dog_id = db.Column(db.Integer, db.ForeignKey('dogs.id'))
+    dog = db.relationship('Dog')
+    event_type_id = db.Column(db.Integer, db.ForeignKey('event_types.id'))
+    event_type = db.relationship('EventType')
+    hours = db.Column(db.Integer, default=0)
+    months = db.Column(db.Integer, default=0)
+
+    def __repr__(self):
+        return '<Schedule {} [{} {}]>'.format(self.id, self.dog_id, self.event_type_id)
+
+    @property
+    def interval(self):
+        """Returns the time between events, add it to the last event's start_time to get the next due time.
+
+        Returns:
+            relativedelta: Interval of months and hours
+
+        """
+        return relativedelta(months=self.months or 0, hours=self.hours or 0)
+
+    @classmethod
+    def with_last_event(cls):
+        """Load every schedule with the start_time of its last matching event in a single query, using the
+        (event_type_id, start_time) and (dog_id, event_id) indexes.
+
+        Returns:
+            list of tuple: (Schedule, datetime.datetime or None) pairs
+
+        """
+        last = db.session.query(func.max(Event.start_time)).\
+            join(dog_to_event, dog_to_event.c.event_id == Event.id).\
+            filter(Event.event_type_id == cls.event_type_id).\
+            filter(dog_to_event.c.dog_id == cls.dog_id).\
+            correlate(cls).\
+            as_scalar()
+        return db.session.query(cls, last).all()
+
 
 def _convert_times(data):
     """Check and convert datetime attrs from seed_data.yml
@@ -308,7 +923,7 @@ def clear_db():
         None
 
     """
-    for model in [Event, EventType, Dog, Users, ActiveEvent]:
+    for model in [Event, EventType, Dog, Users, ActiveEvent, IdempotencyKey, Schedule, ChangeLog]:
         db.session.query(model).delete()
     db.session.commit()
 
@@ -358,6 +973,13 @@ def seed_db():
             app.logger.info('%s', e)
             db.session.add(e)
 
+    app.logger.info('Adding Schedules')
+    for schedule in data.get('Schedule', {}):
+        _data = dict(data['Schedule'][schedule])
+        dog = Dog.query.filter_by(name=_data.pop('dog')).first()
+        event_type = EventType.query.filter_by(name=_data.pop('event_type')).first()
+        db.session.add(Schedule(dog=dog, event_type=event_type, **_data))
+
     app.logger.info('Committing DB')
     db.session.commit()
     app.logger.info('Done!')
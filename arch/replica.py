@@ -0,0 +1,136 @@
+import time
+import sqlite3
+import threading
+
+import flask
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.dml import UpdateBase
+
+from arch import utils
+
+REPLICA_BIND = 'replica'
+
+
+def _replica_enabled(app):
+    return REPLICA_BIND in (app.config.get('SQLALCHEMY_BINDS') or {})
+
+
+def _use_replica():
+    """Decide if reads for the current request can go to the replica. Only GET/HEAD requests use the replica, and not
+    once the request has written or while the client's session is sticky to the primary after a recent write.
+
+    Returns:
+        bool: True if the replica should serve reads
+
+    """
+    if not flask.has_request_context():
+        return False
+    if flask.request.method not in ('GET', 'HEAD'):
+        return False
+    if flask.g.get('db_wrote'):
+        return False
+    return flask.session.get('primary_until', 0) < time.time()
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends writes to the primary database and, for read only requests, reads to the replica bind."""
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if mapper is not None and mapper.persist_selectable.info.get('bind_key') is not None:
+            return SignallingSession.get_bind(self, mapper, clause)
+        if self._flushing or isinstance(clause, UpdateBase):
+            if flask.has_request_context():
+                flask.g.db_wrote = True
+        elif _replica_enabled(self.app) and _use_replica():
+            return self.db.get_engine(self.app, bind=REPLICA_BIND)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension using `RoutingSession` for its sessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def refresh_snapshot(primary_uri, replica_uri):
+    """Copy a SQLite primary into the replica file using SQLite's online backup API, so writers aren't blocked and
+    readers of the replica see a consistent snapshot.
+
+    Args:
+        primary_uri (str): SQLAlchemy URI of the primary database
+        replica_uri (str): SQLAlchemy URI of the replica database
+
+    Returns:
+        None
+
+    """
+    src = sqlite3.connect(make_url(primary_uri).database)
+    dst = sqlite3.connect(make_url(replica_uri).database)
+    try:
+        with dst:
+            src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def init_app(app):
+    """Set up the replica for an app. When both databases are SQLite the replica is a snapshot of the primary, refreshed
+    before the first request is served and then every REPLICA_SNAPSHOT_INTERVAL seconds in a background thread. Only
+    the serving process holding the replica's lock file refreshes it, so CLI commands and the debug reloader's watcher
+    process never do. After a request writes, the client's session sticks to the primary for REPLICA_STICKY_SECONDS.
+
+    Args:
+        app (flask.Flask): Application to set up
+
+    Returns:
+        None
+
+    Raises:
+        RuntimeError: If both databases are SQLite and REPLICA_SNAPSHOT_INTERVAL isn't set, the replica would never be
+            refreshed
+
+    """
+    if not _replica_enabled(app):
+        return
+
+    primary_uri = app.config['SQLALCHEMY_DATABASE_URI']
+    replica_uri = app.config['SQLALCHEMY_BINDS'][REPLICA_BIND]
+    interval = app.config.get('REPLICA_SNAPSHOT_INTERVAL')
+
+    @app.after_request
+    def _stick_to_primary(response):
+        if flask.g.get('db_wrote'):
+            flask.session['primary_until'] = time.time() + app.config['REPLICA_STICKY_SECONDS']
+        return response
+
+    if primary_uri.startswith('sqlite') and replica_uri.startswith('sqlite'):
+        if not interval:
+            raise RuntimeError('REPLICA_SNAPSHOT_INTERVAL must be set for a SQLite replica')
+        lock_path = make_url(replica_uri).database + '.lock'
+
+        def _refresh_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    refresh_snapshot(primary_uri, replica_uri)
+                except Exception:
+                    app.logger.exception('Unable to refresh replica snapshot')
+
+        @app.before_first_request
+        def _start_refresh():
+            lock = utils.acquire_lock(lock_path)
+            if lock is None:
+                app.logger.info('Replica snapshot is refreshed by another process')
+                return
+            app.extensions['replica_lock'] = lock
+            refresh_snapshot(primary_uri, replica_uri)
+            thread = threading.Thread(target=_refresh_loop, name='replica-snapshot', daemon=True)
+            thread.start()
@@ -14,7 +14,7 @@ def index():
               'title': 'Home',
               'time_of_day': utils.get_tod(),
               'today': datetime.date.today().strftime('%m/%d/%Y'),
-              'events': models.Event.query.all()}
+              'events': models.Event.views()}
     return flask.render_template('index.html', **kwargs)
 
 
@@ -72,6 +72,7 @@ def delete_event(event_id):
         flask.flash('Cannot find event {} to delete'.format(event_id))
         return flask.redirect(flask.url_for('index'))
     if flask.request.method == 'POST':
+        models.IdempotencyKey.forget_events([event.id])
         db.session.delete(event)
         db.session.commit()
         flask.flash('Deleted event {}'.format(event_id))
@@ -130,19 +131,241 @@ def add_event_webhook():
 
     # If no JSON data, try args
     if not data:
-        data = flask.request.args
+        data = flask.request.args.to_dict()
         if not data:
             return utils.log_and_return_error('No Data Passed')
 
+    # Idempotency key from the header or payload, otherwise derived from the event itself
+    key = flask.request.headers.get('Idempotency-Key') or data.pop('idempotency_key', None)
+
+    # Senders using the Event column names (user_id, event_type_id) get events without dogs, as they always have
+    if 'user_id' in data or 'event_type_id' in data:
+        data.setdefault('user', data.pop('user_id', None))
+        data.setdefault('event_type', data.pop('event_type_id', None))
+        data.setdefault('dogs', [])
+
     # Create event and add to database
-    event = models.Event(**data)
+    event = models.Event.event_factory(**data)
 
     if isinstance(event, int):
         db.session.rollback()
         return utils.log_and_return_error('Error generating event')
 
-    db.session.add(event)
-    db.session.commit()
+    if not key:
+        key = models.IdempotencyKey.derive(event, start_time_given='start_time' in data)
+
+    event_id, created = models.IdempotencyKey.add_event(event, key)
+    if not created:
+        app.logger.info('Duplicate submission for key %s, returning event %s', key, event_id)
+        return str({"success": "true", "event_id": event_id, "duplicate": "true"})
 
     app.logger.info(event)
-    return str({"success": "true", "event_id": event.id})
+    return str({"success": "true", "event_id": event_id})
+
+
+@app.route('/bulk_events.html', methods=['GET', 'POST'])
+def bulk_events():
+    f = forms.BulkEventForm(flask.request.form)
+    if f.validate_on_submit():
+        app.logger.info('Submission Validated')
+        try:
+            event_ids = [int(i) for i in f.event_ids.data.replace(',', ' ').split()] if f.event_ids.data else None
+        except ValueError:
+            flask.flash('Bad event id list: {}'.format(f.event_ids.data))
+            return flask.render_template('bulk_events.html', form=f)
+
+        start_time, end_time = utils.get_day_range_in_utc(f.filter_date.data) if f.filter_date.data else (None, None)
+        ids = models.Event.bulk_ids(event_ids=event_ids,
+                                    user_id=f.filter_user.data,
+                                    dog_id=f.filter_dog.data,
+                                    event_type_id=f.filter_event.data,
+                                    start_time=start_time,
+                                    end_time=end_time)
+        if not ids:
+            flask.flash('No events matched the selection')
+            return flask.render_template('bulk_events.html', form=f)
+
+        if f.delete.data:
+            result = models.Event.bulk_delete(ids)
+            flask.flash('Deleted {} events'.format(result['events']))
+        else:
+            result = models.Event.bulk_update(ids,
+                                              user_id=f.user.data,
+                                              event_type_id=f.event.data,
+                                              is_accident=bool(int(f.accident.data)) if f.accident.data else None,
+                                              time_shift=datetime.timedelta(minutes=f.time_shift.data)
+                                              if f.time_shift.data else None,
+                                              dog_ids=f.dog.data if f.dog.data else None)
+            app.logger.info('Bulk edit result: %s', result)
+            flask.flash('Edited {events} events and set dogs on {dogs} links'.format(**result))
+        return flask.redirect(flask.url_for('index'))
+
+    return flask.render_template('bulk_events.html', form=f)
+
+
+@app.route('/bulk_event_webhook.html', methods=['POST', 'GET'])
+def bulk_event_webhook():
+    if flask.request.method == 'GET':
+        return '<h1>This is a simple webhook for editing or deleting events in bulk</h1>'
+
+    try:
+        data = flask.request.get_json()
+    except Exception:
+        return utils.log_and_return_error("Bad JSON Data", exception=True)
+
+    if not isinstance(data, dict) or not data.get('filter'):
+        return utils.log_and_return_error('No Filter Passed')
+    if not isinstance(data['filter'], dict):
+        return utils.log_and_return_error('Bad Filter')
+
+    selection = dict(data['filter'])
+    for t_arg in ['start_time', 'end_time']:
+        if isinstance(selection.get(t_arg), int):
+            selection[t_arg] = datetime.datetime.utcfromtimestamp(selection[t_arg])
+
+    try:
+        ids = models.Event.bulk_ids(**selection)
+    except TypeError:
+        return utils.log_and_return_error('Bad Filter', exception=True)
+
+    if data.get('delete'):
+        result = models.Event.bulk_delete(ids)
+    else:
+        try:
+            changes = dict(data.get('changes') or {})
+            if changes.get('time_shift'):
+                changes['time_shift'] = datetime.timedelta(seconds=int(changes['time_shift']))
+            result = models.Event.bulk_update(ids, **changes)
+        except (TypeError, ValueError):
+            return utils.log_and_return_error('Bad Changes', exception=True)
+
+    app.logger.info('Bulk operation on %s events: %s', len(ids), result)
+    return str({"success": "true", "matched": len(ids), "affected": result})
+
+
+@app.route('/sync', methods=['GET', 'POST'])
+def sync():
+    """Delta sync for offline clients.
+
+    GET `/sync?since=<cursor>&limit=<n>` returns the changes after the cursor along with the next cursor, call it
+    again with the new cursor while 'more' is true.
+
+    POST a batch of event changes made offline as JSON,
+    `{"since": <cursor>, "changes": [{"client_id": ..., "op": "insert|update|delete", "id": ..., "data": {...}}]}`.
+    Updates and deletes of events changed on the server after `since`, other than by earlier changes in the same
+    batch, are rejected as conflicts along with the current server copy of the event. Each applied change returns the
+    'cursor' of its change log entry.
+
+    """
+    if flask.request.method == 'GET':
+        try:
+            since = int(flask.request.args.get('since', 0))
+            limit = max(1, min(int(flask.request.args.get('limit', 500)), 1000))
+        except ValueError:
+            return flask.jsonify({'success': 'false', 'error': 'Bad cursor or limit'}), 400
+        return flask.jsonify(models.ChangeLog.changes_since(since, limit=limit))
+
+    data = flask.request.get_json(silent=True)
+    error = _validate_sync_upload(data)
+    if error:
+        return flask.jsonify({'success': 'false', 'error': error}), 400
+
+    since = int(data.get('since', 0))
+    own_changes = {}
+    results = []
+    for change in data['changes']:
+        try:
+            results.append(_apply_sync_change(change, since, own_changes))
+        except Exception:
+            db.session.rollback()
+            app.logger.exception('Unable to apply sync change %s', change.get('client_id'))
+            results.append({'client_id': change.get('client_id'), 'status': 'error', 'error': 'Unable to apply change'})
+    return flask.jsonify({'success': 'true', 'results': results})
+
+
+def _validate_sync_upload(data):
+    """Check the shape of a sync upload before any of it is applied.
+
+    Args:
+        data (dict): Uploaded JSON
+
+    Returns:
+        str: Error message, or None if the upload is valid
+
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('changes'), list):
+        return 'No Changes Passed'
+    try:
+        if int(data.get('since', 0)) < 0:
+            return 'Bad cursor'
+    except (TypeError, ValueError):
+        return 'Bad cursor'
+    for i, change in enumerate(data['changes']):
+        if not isinstance(change, dict):
+            return 'Change {} is not an object'.format(i)
+        if change.get('op') not in ('insert', 'update', 'delete'):
+            return 'Change {} has an unknown op'.format(i)
+        if change['op'] != 'insert' and not isinstance(change.get('id'), int):
+            return 'Change {} has no event id'.format(i)
+        if not isinstance(change.get('data') or {}, dict):
+            return 'Change {} data is not an object'.format(i)
+    return None
+
+
+def _apply_sync_change(change, since, own_changes):
+    """Apply a single uploaded event change.
+
+    Args:
+        change (dict): Change with 'op', 'id' for updates and deletes, 'data' for inserts and updates and an optional
+            'client_id' echoed back
+        since (int): Cursor the client's changes were based on
+        own_changes (dict): Event id -> change log id of the last change this batch made to it, updated in place
+
+    Returns:
+        dict: Result with 'status' of 'ok', 'conflict' or 'error'
+
+    """
+    table_name = models.Event.__tablename__
+    result = {'client_id': change.get('client_id'), 'status': 'ok'}
+    op = change['op']
+    fields = dict(change.get('data') or {})
+
+    if op == 'insert':
+        key = fields.pop('idempotency_key', None)
+        event = models.Event.event_factory(**fields)
+        if isinstance(event, int):
+            db.session.rollback()
+            result.update(status='error', error='Error generating event')
+            return result
+        key = key or models.IdempotencyKey.derive(event, start_time_given='start_time' in fields)
+        result['id'], _ = models.IdempotencyKey.add_event(event, key)
+        result['cursor'] = own_changes[result['id']] = models.ChangeLog.last_change(table_name, result['id'])
+        return result
+
+    event = models.Event.query.get(change['id'])
+    if event is None:
+        result.update(status='error', error='Unknown event')
+        return result
+    result['id'] = event.id
+
+    if models.ChangeLog.has_conflict(table_name, event.id, max(since, own_changes.get(event.id, 0))):
+        result.update(status='conflict', server=event.to_dict())
+        return result
+
+    if op == 'delete':
+        models.Event.bulk_delete([result['id']])
+        result['cursor'] = own_changes[result['id']] = models.ChangeLog.last_change(table_name, result['id'])
+        return result
+
+    for arg in ['user_id', 'event_type_id', 'note', 'is_accident']:
+        if arg in fields:
+            setattr(event, arg, fields[arg])
+    for t_arg in ['start_time', 'end_time']:
+        if t_arg in fields:
+            t_data = fields[t_arg]
+            setattr(event, t_arg, datetime.datetime.utcfromtimestamp(t_data) if isinstance(t_data, int) else t_data)
+    if 'dog_ids' in fields:
+        event.dogs = models.Dog.query.filter(models.Dog.id.in_(tuple(fields['dog_ids']))).all()
+    db.session.commit()
+    result['cursor'] = own_changes[event.id] = models.ChangeLog.last_change(table_name, event.id)
+    return result
@@ -0,0 +1,323 @@
+import json
+import heapq
+import datetime
+import threading
+import urllib.request
+
+import click
+import pytz
+from sqlalchemy import event as sa_event, func, inspect, select, orm, or_
+
+from arch import db, models, utils
+
+PENDING_EVENTS = 'reminder_pending_events'  #: Session info key for inserted events waiting on their commit
+
+
+class ReminderScheduler(object):
+    """In-process scheduler for recurring events (eg medicine and feeding). Next due times are kept in a heap keyed by
+    schedule, loaded once from the database at startup and moved forward in memory as matching events are logged, so
+    nothing polls the events table. Only the small schedules table is checked every SCHEDULE_CHECK, to pick up
+    schedules added or removed by `flask schedules` in another process. A reminder fires only when a schedule is
+    overdue and repeats every `repeat` until a matching event is logged.
+
+    Args:
+        app (flask.Flask): Application, used for config, logging and an app context for the initial load
+        repeat (datetime.timedelta): Time between repeated reminders for the same overdue schedule
+
+    """
+    SCHEDULE_CHECK = datetime.timedelta(minutes=1)
+
+    def __init__(self, app, repeat=datetime.timedelta(hours=1)):
+        self.app = app
+        self.repeat = repeat
+        self._heap = []        # (fire_at, schedule_id) entries, stale entries are skipped when popped
+        self._fire_at = {}     # schedule_id -> fire_at of the live heap entry
+        self._due = {}         # schedule_id -> next due time
+        self._last = {}        # schedule_id -> start_time of the last matching event when loaded
+        self._schedules = {}   # schedule_id -> (dog_id, event_type_id, interval, description)
+        self._cond = threading.Condition()
+        self._reload = False
+        self._version = None   # Schedules table version the heap was loaded from
+        self._next_check = None
+        self._thread = None
+
+    @staticmethod
+    def _schedule_version():
+        """Cheap fingerprint of the schedules table, changes when schedules are added, removed or edited."""
+        return tuple(db.session.query(func.count(models.Schedule.id), func.max(models.Schedule.id),
+                                      func.sum(models.Schedule.hours), func.sum(models.Schedule.months)).one())
+
+    def load(self):
+        """Load every schedule and the last matching event with a single query and rebuild the heap. Schedules whose
+        last event and interval haven't changed keep their due time and pending repeat, so a reload doesn't re-send
+        reminders.
+
+        Returns:
+            None
+
+        """
+        now = datetime.datetime.utcnow()
+        with self.app.app_context():
+            rows = models.Schedule.with_last_event()
+            version = self._schedule_version()
+            with self._cond:
+                old = {i: (self._last.get(i), s[2], self._due[i], self._fire_at[i]) for i, s in self._schedules.items()}
+                self._version = version
+                self._heap = []
+                self._fire_at = {}
+                self._due = {}
+                self._last = {}
+                self._schedules = {}
+                for schedule, last in rows:
+                    self._schedules[schedule.id] = (schedule.dog_id, schedule.event_type_id, schedule.interval,
+                                                    '{} {}'.format(schedule.dog.name, schedule.event_type.name))
+                    self._last[schedule.id] = last
+                    previous = old.get(schedule.id)
+                    if previous and previous[:2] == (last, schedule.interval):
+                        self._push(schedule.id, previous[2], fire_at=previous[3])
+                    else:
+                        self._push(schedule.id, last + schedule.interval if last else now)
+                self._cond.notify()
+        self.app.logger.info('Loaded %s reminder schedules', len(rows))
+
+    def _push(self, schedule_id, due, fire_at=None):
+        self._due[schedule_id] = due
+        self._fire_at[schedule_id] = fire_at or due
+        heapq.heappush(self._heap, (fire_at or due, schedule_id))
+
+    def event_logged(self, dog_ids, event_type_id, start_time):
+        """Move the matching schedules forward after an event is logged.
+
+        Args:
+            dog_ids (list of int): Dogs the event was for
+            event_type_id (int): Event Type ID of the event
+            start_time (datetime.datetime): Start time of the event in UTC
+
+        Returns:
+            None
+
+        """
+        if not start_time:
+            return
+        if start_time.tzinfo:
+            start_time = start_time.astimezone(pytz.utc).replace(tzinfo=None)
+        with self._cond:
+            for schedule_id, (dog_id, type_id, interval, _) in self._schedules.items():
+                if type_id != event_type_id or dog_id not in dog_ids:
+                    continue
+                due = start_time + interval
+                if due > self._due[schedule_id]:
+                    self._push(schedule_id, due)
+            self._cond.notify()
+
+    def request_reload(self):
+        """Ask the scheduler thread to reload every schedule from the database, used when events are edited or deleted
+        since that can move a due time back.
+
+        Returns:
+            None
+
+        """
+        with self._cond:
+            self._reload = True
+            self._cond.notify()
+
+    def pop_overdue(self, now=None):
+        """Pop every schedule whose reminder is due and re-arm it to repeat.
+
+        Args:
+            now (datetime.datetime): Current time in UTC, defaults to utcnow
+
+        Returns:
+            list of tuple: (schedule_id, description, due) for each overdue schedule
+
+        """
+        now = now or datetime.datetime.utcnow()
+        overdue = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                fire_at, schedule_id = heapq.heappop(self._heap)
+                if self._fire_at.get(schedule_id) != fire_at:
+                    continue  # Stale entry, the schedule was moved forward
+                due = self._due[schedule_id]
+                overdue.append((schedule_id, self._schedules[schedule_id][3], due))
+                self._push(schedule_id, due, fire_at=now + self.repeat)
+        return overdue
+
+    def notify(self, schedule_id, description, due):
+        """Send a reminder to the log and, if REMINDER_WEBHOOK_URL is set, POST it as JSON to that URL.
+
+        Args:
+            schedule_id (int): Overdue schedule ID
+            description (str): '$Dog $EVENT' description of the schedule
+            due (datetime.datetime): When the event was due in UTC
+
+        Returns:
+            None
+
+        """
+        self.app.logger.warning('Reminder: %s overdue since %s UTC', description, due.strftime('%Y-%m-%d %H:%M'))
+        url = self.app.config.get('REMINDER_WEBHOOK_URL')
+        if not url:
+            return
+        data = json.dumps({'schedule_id': schedule_id, 'reminder': description, 'due': due.isoformat()})
+        request = urllib.request.Request(url, data=data.encode('utf-8'), headers={'Content-Type': 'application/json'})
+        try:
+            urllib.request.urlopen(request, timeout=10).close()
+        except Exception:
+            self.app.logger.exception('Unable to send reminder to %s', url)
+
+    def _check_schedules(self):
+        now = datetime.datetime.utcnow()
+        if self._next_check and now < self._next_check:
+            return
+        self._next_check = now + self.SCHEDULE_CHECK
+        with self.app.app_context():
+            if self._schedule_version() != self._version:
+                self._reload = True
+
+    def _run(self):
+        while True:
+            try:
+                self._check_schedules()
+            except Exception:
+                self.app.logger.exception('Unable to check reminder schedules')
+            if self._reload:
+                self._reload = False
+                try:
+                    self.load()
+                except Exception:
+                    self.app.logger.exception('Unable to reload reminder schedules')
+            for overdue in self.pop_overdue():
+                self.notify(*overdue)
+            with self._cond:
+                now = datetime.datetime.utcnow()
+                timeout = (self._next_check - now).total_seconds()
+                if self._heap:
+                    timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
+                timeout = max(timeout, 0)
+                if not self._reload:
+                    self._cond.wait(timeout)
+
+    def start(self):
+        """Load the schedules and start the background thread.
+
+        Returns:
+            None
+
+        """
+        self.load()
+        self._thread = threading.Thread(target=self._run, name='reminder-scheduler', daemon=True)
+        self._thread.start()
+
+
+def _find(model, name_field, value):
+    row = model.query.filter(or_(name_field == value, model.id == value)).first()
+    if row is None:
+        raise click.BadParameter('No {} named {!r}'.format(model.__name__, value))
+    return row
+
+
+def init_app(app):
+    """Register the `flask schedules` commands and set up the reminder scheduler if REMINDERS_ENABLED is set. Logged
+    events move the heap forward once their transaction commits, edits and deletes (including the set based bulk
+    operations) reload the schedules instead. The scheduler starts as soon as the serving process loads the app, and
+    only in the process holding REMINDER_LOCK_FILE, so CLI commands and the debug reloader's watcher process never run
+    it.
+
+    Args:
+        app (flask.Flask): Application to set up
+
+    Returns:
+        ReminderScheduler: Scheduler or None
+
+    """
+    @app.cli.group('schedules')
+    def schedules_command():
+        """List, add and remove reminder schedules."""
+
+    @schedules_command.command('list')
+    def list_command():
+        """List every schedule with its last matching event."""
+        for schedule, last in models.Schedule.with_last_event():
+            click.echo('{}: {} {} every {} months {} hours, last {}'.format(
+                schedule.id, schedule.dog.name, schedule.event_type.name, schedule.months or 0, schedule.hours or 0,
+                '{} UTC'.format(last.strftime('%Y-%m-%d %H:%M')) if last else 'never'))
+
+    @schedules_command.command('add')
+    @click.argument('dog')
+    @click.argument('event_type')
+    @click.option('--hours', type=click.IntRange(min=0), default=0, help='Hours between events.')
+    @click.option('--months', type=click.IntRange(min=0), default=0, help='Months between events, added to hours.')
+    def add_command(dog, event_type, hours, months):
+        """Expect EVENT_TYPE for DOG (names or ids) every --months and --hours."""
+        if not hours and not months:
+            raise click.UsageError('Pass --hours and/or --months')
+        schedule = models.Schedule(dog=_find(models.Dog, models.Dog.name, dog),
+                                   event_type=_find(models.EventType, models.EventType.name, event_type.upper()),
+                                   hours=hours, months=months)
+        db.session.add(schedule)
+        db.session.commit()
+        click.echo('Added schedule {}'.format(schedule.id))
+
+    @schedules_command.command('remove')
+    @click.argument('schedule_id', type=int)
+    def remove_command(schedule_id):
+        """Remove the schedule SCHEDULE_ID."""
+        schedule = models.Schedule.query.get(schedule_id)
+        if schedule is None:
+            raise click.ClickException('No schedule {}'.format(schedule_id))
+        db.session.delete(schedule)
+        db.session.commit()
+        click.echo('Removed schedule {}'.format(schedule_id))
+
+    if not app.config.get('REMINDERS_ENABLED'):
+        return None
+
+    scheduler = ReminderScheduler(app, repeat=datetime.timedelta(seconds=app.config['REMINDER_REPEAT']))
+
+    def _event_inserted(mapper, connection, target):
+        try:
+            if 'dogs' in inspect(target).unloaded:
+                query = select([models.dog_to_event.c.dog_id]).where(models.dog_to_event.c.event_id == target.id)
+                dog_ids = [r.dog_id for r in connection.execute(query)]
+            else:
+                dog_ids = [d.id for d in target.dogs]
+            session = orm.object_session(target)
+            session.info.setdefault(PENDING_EVENTS, []).append((dog_ids, target.event_type_id, target.start_time))
+        except Exception:
+            app.logger.exception('Unable to update reminder schedules for %s', target.id)
+
+    def _event_changed(mapper, connection, target):
+        orm.object_session(target).info[models.EVENTS_CHANGED] = True
+
+    def _after_commit(session):
+        for args in session.info.pop(PENDING_EVENTS, []):
+            scheduler.event_logged(*args)
+        if session.info.pop(models.EVENTS_CHANGED, False):
+            scheduler.request_reload()
+
+    def _after_rollback(session):
+        session.info.pop(PENDING_EVENTS, None)
+        session.info.pop(models.EVENTS_CHANGED, None)
+
+    sa_event.listen(models.Event, 'after_insert', _event_inserted)
+    sa_event.listen(models.Event, 'after_update', _event_changed)
+    sa_event.listen(models.Event, 'after_delete', _event_changed)
+    sa_event.listen(db.session, 'after_commit', _after_commit)
+    sa_event.listen(db.session, 'after_rollback', _after_rollback)
+
+    def _start_scheduler():
+        lock = utils.acquire_lock(app.config['REMINDER_LOCK_FILE'])
+        if lock is None:
+            app.logger.info('Reminders are run by another process')
+            return
+        app.extensions['reminder_lock'] = lock
+        try:
+            scheduler.start()
+        except Exception:
+            app.logger.exception('Unable to start the reminder scheduler')
+
+    utils.on_serve(app, _start_scheduler)
+
+    return scheduler
@@ -1,5 +1,10 @@
+import os
+import fcntl
 import datetime
+import threading
+import collections
 
+import click
 import pytz
 
 from arch import app
@@ -49,3 +54,109 @@ def get_tod():
         return "evening"
     else:               # 8pm - 6am
         return "night"
+
+
+def get_day_range_in_utc(date):
+    """Get the UTC bounds of a local (Los Angeles) calendar day.
+
+    Args:
+        date (datetime.date): Local day
+
+    Returns:
+        tuple of datetime.datetime: Naive UTC start (inclusive) and end (exclusive) of the day
+
+    """
+    tz = pytz.timezone("America/Los_Angeles")
+    start = tz.localize(datetime.datetime.combine(date, datetime.time.min))
+    end = tz.localize(datetime.datetime.combine(date + datetime.timedelta(days=1), datetime.time.min))
+    return start.astimezone(pytz.utc).replace(tzinfo=None), end.astimezone(pytz.utc).replace(tzinfo=None)
+
+
+class LRUCache(object):
+    """Small in-memory least recently used cache.
+
+    Args:
+        max_size (int): Maximum number of items to hold before the oldest is dropped
+
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+
+def acquire_lock(path):
+    """Take an exclusive, non-blocking lock on a lock file so only one process runs a job. The lock is held until the
+    returned file is closed, or the process exits.
+
+    Args:
+        path (str): Lock file path
+
+    Returns:
+        file: Open lock file, keep a reference to hold the lock. None if another process holds it.
+
+    """
+    f = open(path, 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+def is_serving_process():
+    """Check if this process is the one `flask run` serves requests from. With the debug reloader that is the worker
+    process, never the watcher, and other CLI commands are never serving.
+
+    Returns:
+        bool: True if this process serves requests
+
+    """
+    if 'WERKZEUG_RUN_MAIN' in os.environ:
+        return os.environ['WERKZEUG_RUN_MAIN'] == 'true'
+    ctx = click.get_current_context(silent=True)
+    return ctx is not None and ctx.info_name == 'run'
+
+
+def on_serve(app, func):
+    """Call `func` once in the serving process: right away when `flask run` loads the app, otherwise (eg another WSGI
+    server) before the first request.
+
+    Args:
+        app (flask.Flask): Application
+        func (callable): Called with no arguments
+
+    Returns:
+        None
+
+    """
+    started = []
+
+    def _start():
+        if not started:
+            started.append(True)
+            func()
+
+    app.before_first_request(_start)
+    if is_serving_process():
+        _start()
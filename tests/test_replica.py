@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import flask
+
+# The app reads its config on import, so point it at a two-file SQLite primary/replica setup first
+_tmp = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmp, 'primary.db')
+os.environ['REPLICA_DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmp, 'replica.db')
+os.environ['REPLICA_SNAPSHOT_INTERVAL'] = '3600'
+
+from arch import app, db, models, replica  # noqa: E402
+
+
+def _event_count(client):
+    return client.get('/').data.count(b'event_shadow')
+
+
+class ReplicaTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        db.create_all()
+        db.session.add(models.Users(username='David'))
+        db.session.add(models.Dog(name='Archie'))
+        db.session.add(models.EventType(name='PEE'))
+        db.session.commit()
+        db.session.add(models.Event.event_factory(user='David', event_type='PEE'))
+        db.session.commit()
+        app.test_client().get('/')  # Runs the first request hooks, which take the initial snapshot
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.remove()
+        shutil.rmtree(_tmp, ignore_errors=True)
+
+    def setUp(self):
+        replica.refresh_snapshot(app.config['SQLALCHEMY_DATABASE_URI'], app.config['SQLALCHEMY_BINDS']['replica'])
+
+    def _add_event(self, client):
+        result = client.post('/add_event_webhook.html', json={'user': 'David', 'event_type': 'PEE'})
+        self.assertIn(b"'success': 'true'", result.data)
+
+    def test_get_reads_replica(self):
+        before = _event_count(app.test_client())
+        self._add_event(app.test_client())
+        self.assertEqual(_event_count(app.test_client()), before)
+
+    def test_writer_reads_own_writes(self):
+        writer = app.test_client()
+        before = _event_count(writer)
+        self._add_event(writer)
+        self.assertEqual(_event_count(writer), before + 1)
+
+    def test_refresh_updates_replica(self):
+        reader = app.test_client()
+        before = _event_count(reader)
+        self._add_event(app.test_client())
+        self.setUp()
+        self.assertEqual(_event_count(reader), before + 1)
+
+    def test_writes_go_to_primary(self):
+        with app.test_request_context('/', method='GET'):
+            self.assertEqual(db.session.get_bind(), db.get_engine(app, bind=replica.REPLICA_BIND))
+            self.assertEqual(db.session.get_bind(clause=models.Event.__table__.insert()), db.engine)
+
+    def test_sqlite_replica_requires_interval(self):
+        other = flask.Flask(__name__)
+        other.config.update(SQLALCHEMY_DATABASE_URI=app.config['SQLALCHEMY_DATABASE_URI'],
+                            SQLALCHEMY_BINDS=app.config['SQLALCHEMY_BINDS'],
+                            REPLICA_SNAPSHOT_INTERVAL=0)
+        with self.assertRaises(RuntimeError):
+            replica.init_app(other)
+
+
+if __name__ == '__main__':
+    unittest.main()